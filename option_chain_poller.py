@@ -15,13 +15,26 @@ import logging
 import asyncio
 import ssl
 import threading
+import queue
 from urllib.parse import urljoin
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import random
+import datetime
+from zoneinfo import ZoneInfo
 
 # choose your websocket client
 import websockets  # pip install websockets
 
+# configure logging before any import-time warnings below, or they would set up the root logger first
+_LOG_LEVEL_NAME = (os.getenv("LOG_LEVEL") or "INFO").upper()
+_LOG_LEVEL = logging.getLevelName(_LOG_LEVEL_NAME)  # int for known names, "Level X" string otherwise
+_LOG_LEVEL_VALID = isinstance(_LOG_LEVEL, int)
+logging.basicConfig(level=_LOG_LEVEL if _LOG_LEVEL_VALID else logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+if not _LOG_LEVEL_VALID:
+    logging.warning("Unknown LOG_LEVEL=%r; using INFO.", os.getenv("LOG_LEVEL"))
+
 # Optional: protobuf decoding. If you compile MarketData.proto into marketdata_pb2.py, set USE_PROTO=True
 USE_PROTO = True
 try:
@@ -31,7 +44,20 @@ except Exception as e:
     logging.warning("Proto import failed: %s. Binary payloads will be logged raw. Set USE_PROTO=False to silence.", e)
     USE_PROTO = False
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+# Optional: orjson parses/serializes text frames several times faster than stdlib json
+try:
+    import orjson
+    def _json_loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN/Infinity, which stdlib json (the previous parser) accepts
+            return json.loads(data)
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
 
 # ---------- Configuration (ENV) ----------
 UPSTOX_ACCESS_TOKEN = os.getenv("UPSTOX_ACCESS_TOKEN") or ""
@@ -44,23 +70,90 @@ RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY") or 60.0)
 DEFAULT_SUBSCRIBE_BATCH = int(os.getenv("DEFAULT_SUBSCRIBE_BATCH") or 100)  # how many instruments to include in one 'subscribe' message
 WS_READ_TIMEOUT = int(os.getenv("WS_READ_TIMEOUT") or 60)  # seconds to wait for a message before considering connection unhealthy
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL") or 25)  # if the server expects heartbeats
+TICK_QUEUE_MAX = int(os.getenv("TICK_QUEUE_MAX") or 10000)  # decoded messages buffered for on_tick before dropping
+OFF_HOURS_CONNECT = (os.getenv("OFF_HOURS_CONNECT") or "0") == "1"  # 1 = stay connected outside NSE market hours
+
+if TICK_QUEUE_MAX < 1:
+    # Queue(maxsize=0) would be unbounded, the opposite of what the setting promises
+    logging.warning("TICK_QUEUE_MAX must be >= 1 (got %d); using 10000.", TICK_QUEUE_MAX)
+    TICK_QUEUE_MAX = 10000
 
 if not UPSTOX_ACCESS_TOKEN:
     logging.error("Set UPSTOX_ACCESS_TOKEN in environment and re-run.")
     raise SystemExit(1)
 
+# ---------- HTTP session ----------
+# One pooled session for all REST calls so reconnects reuse the TLS connection
+# to api.upstox.com instead of paying a fresh handshake on every authorize.
+SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json", "Authorization": f"Bearer {UPSTOX_ACCESS_TOKEN}"})
+_adapter = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    # 429 is deliberately absent: _authorize honours its Retry-After once, at the reconnect loop
+    max_retries=Retry(total=2, backoff_factor=1, status_forcelist=(500, 502, 503, 504), raise_on_status=False),
+)
+SESSION.mount("https://", _adapter)
+
 # ---------- Utility helpers ----------
-def get_authorized_ws_url():
+RETRY_AFTER_MAX = 300.0  # never sleep longer than this on a server-supplied Retry-After
+
+def _jitter(delay):
+    """Spread a delay by +0-50% so many clients never retry in lockstep."""
+    return delay * (1 + random.uniform(0, 0.5))
+
+def _backoff_delay(attempt):
+    """Exponential backoff capped at RECONNECT_MAX_DELAY, then jittered (so capped delays still vary)."""
+    # cap the exponent: attempt keeps growing across long outages and 2**n would overflow float
+    delay = RECONNECT_BASE_DELAY * (2 ** min(max(attempt - 1, 0), 16))
+    return _jitter(min(RECONNECT_MAX_DELAY, delay))
+
+def _retry_after_seconds(resp):
+    """Parse a numeric Retry-After header; None if missing or not in seconds."""
+    try:
+        return max(float(resp.headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+IST = ZoneInfo("Asia/Kolkata")
+MARKET_OPEN = datetime.time(9, 15)
+MARKET_CLOSE = datetime.time(15, 30)
+
+def _market_open_now(now=None):
+    """True during the NSE cash session (Mon-Fri 09:15-15:30 IST). Exchange holidays are not modelled."""
+    now = now or datetime.datetime.now(IST)
+    return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
+
+def _seconds_until_open(now=None):
+    """Seconds until the next session open (0 if the market is open now)."""
+    now = now or datetime.datetime.now(IST)
+    if _market_open_now(now):
+        return 0.0
+    nxt = now.replace(hour=MARKET_OPEN.hour, minute=MARKET_OPEN.minute, second=0, microsecond=0)
+    if now >= nxt:
+        nxt += datetime.timedelta(days=1)
+    while nxt.weekday() >= 5:
+        nxt += datetime.timedelta(days=1)
+    return (nxt - now).total_seconds()
+
+def _authorize():
     """
-    Call authorize endpoint to get a signed websocket URL.
-    Response shape varies by provider; adjust parsing according to your Upstox response.
-    Expected: JSON with {'data': {'socket_url': 'wss://...'}} or similar.
+    Fetch the signed websocket URL.
+    Returns (url, delay_hint): delay_hint is None for normal backoff, the server's
+    Retry-After on HTTP 429, or a jittered RECONNECT_MAX_DELAY for other 4xx
+    (e.g. expired token), which retrying sooner cannot fix.
     """
-    headers = {"Accept": "application/json", "Authorization": f"Bearer {UPSTOX_ACCESS_TOKEN}"}
     try:
-        r = requests.get(MARKET_FEED_AUTHORIZE_URL, headers=headers, timeout=10)
+        r = SESSION.get(MARKET_FEED_AUTHORIZE_URL, timeout=10)
+        if r.status_code == 429:
+            retry_after = _retry_after_seconds(r)
+            logging.warning("Authorize rate-limited (429); Retry-After=%s", retry_after)
+            return None, retry_after
+        if 400 <= r.status_code < 500:
+            logging.error("Authorize rejected with HTTP %d (check UPSTOX_ACCESS_TOKEN): %s", r.status_code, r.text[:200])
+            return None, _jitter(RECONNECT_MAX_DELAY)
         r.raise_for_status()
-        j = r.json()
+        j = _json_loads(r.content)
         # find field - adapt if your response differs
         # common shapes: { "data": { "socket_url": "wss://..." } }
         if isinstance(j, dict):
@@ -69,19 +162,52 @@ def get_authorized_ws_url():
             url = d.get("socket_url") or d.get("socketUrl") or d.get("endpoint") or d.get("ws_url")
             if url:
                 logging.info("Authorized websocket URL obtained.")
-                return url
+                return url, None
         logging.error("Unexpected authorize response shape: %s", j)
     except Exception as e:
         logging.exception("Failed to obtain authorized websocket URL: %s", e)
-    return None
+    return None, None
+
+def get_authorized_ws_url():
+    """
+    Call authorize endpoint to get a signed websocket URL.
+    Response shape varies by provider; adjust parsing according to your Upstox response.
+    Expected: JSON with {'data': {'socket_url': 'wss://...'}} or similar.
+    """
+    return _authorize()[0]
 
 # ---------- WebSocket client class ----------
+_DISPATCH_STOP = object()  # sentinel that tells the dispatcher thread to exit
+
+def _put_drop_oldest(q, item):
+    """put_nowait on a bounded queue, evicting the oldest entry when full. Returns True if something was dropped."""
+    try:
+        q.put_nowait(item)
+        return False
+    except queue.Full:
+        pass
+    try:
+        old = q.get_nowait()
+    except queue.Empty:
+        old = None
+    if old is _DISPATCH_STOP:
+        # the dispatcher must still see its stop sentinel: keep it and drop the new item instead
+        item = old
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        pass
+    return True
+
 class UpstoxWSClient:
     """
     Resilient WebSocket client:
     - background thread runs asyncio loop
     - subscribe/unsubscribe instrument_key strings
     - on_tick callback receives decoded messages: on_tick(message_dict)
+    - callbacks run on a separate dispatcher thread so a slow on_tick never stalls recv;
+      up to TICK_QUEUE_MAX messages are buffered; when full the *oldest* is dropped (and logged),
+      so a lagging callback always catches up on the latest prices
     """
     def __init__(self, on_tick_callback=None):
         self._loop = None
@@ -94,12 +220,21 @@ class UpstoxWSClient:
         self._pending_unsubscribe = set()
         self._lock = threading.Lock()
         self._connected_event = threading.Event()
+        self._tick_queue = queue.Queue(maxsize=TICK_QUEUE_MAX)
+        self._dropped_ticks = 0
+        self._dispatch_thread = None
 
     def start(self):
         """Start background thread that runs the asyncio websocket client."""
         if self._thread and self._thread.is_alive():
             return
         self._closing = False
+        # every run gets its own queue + dispatcher; a previous dispatcher still busy in a slow
+        # on_tick keeps draining its own queue up to its stop sentinel and then exits
+        self._retire_dispatcher()
+        self._tick_queue = queue.Queue(maxsize=TICK_QUEUE_MAX)
+        self._dispatch_thread = threading.Thread(target=self._dispatch_loop, args=(self._tick_queue,), daemon=True)
+        self._dispatch_thread.start()
         self._thread = threading.Thread(target=self._run_loop, daemon=True)
         self._thread.start()
         logging.info("UpstoxWSClient started background thread.")
@@ -115,6 +250,10 @@ class UpstoxWSClient:
                 pass
         if self._thread:
             self._thread.join(timeout=5)
+        dispatcher = self._dispatch_thread
+        self._retire_dispatcher()
+        if dispatcher:
+            dispatcher.join(timeout=5)
         logging.info("UpstoxWSClient stopped.")
 
     def add_instruments(self, keys):
@@ -122,17 +261,39 @@ class UpstoxWSClient:
         if isinstance(keys, str):
             keys = [keys]
         with self._lock:
-            for k in keys:
-                if k not in self.subscriptions:
-                    self._pending_subscribe.add(k)
+            self._pending_subscribe.update(k for k in keys if k not in self.subscriptions)
 
     def remove_instruments(self, keys):
         if isinstance(keys, str):
             keys = [keys]
         with self._lock:
-            for k in keys:
-                if k in self.subscriptions:
-                    self._pending_unsubscribe.add(k)
+            self._pending_unsubscribe.update(k for k in keys if k in self.subscriptions)
+
+    def _retire_dispatcher(self):
+        """Queue the stop sentinel for the current dispatcher (if running) and forget it. Never blocks."""
+        if self._dispatch_thread and self._dispatch_thread.is_alive():
+            _put_drop_oldest(self._tick_queue, _DISPATCH_STOP)
+        self._dispatch_thread = None
+
+    def _emit(self, msg):
+        """Hand a decoded message to the dispatcher thread (never blocks the event loop)."""
+        if _put_drop_oldest(self._tick_queue, msg):
+            # on_tick is not keeping up - shed the stalest tick rather than grow memory without bound
+            self._dropped_ticks += 1
+            if self._dropped_ticks % 1000 == 1:
+                logging.warning("on_tick is falling behind; dropped %d stale message(s) so far (TICK_QUEUE_MAX=%d).",
+                                self._dropped_ticks, TICK_QUEUE_MAX)
+
+    def _dispatch_loop(self, q):
+        """Dispatcher thread: deliver messages from its own queue to on_tick in arrival order."""
+        while True:
+            msg = q.get()
+            if msg is _DISPATCH_STOP:
+                return
+            try:
+                self.on_tick(msg)
+            except Exception as e:
+                logging.exception("on_tick callback failed: %s", e)
 
     def _run_loop(self):
         self._loop = asyncio.new_event_loop()
@@ -147,13 +308,25 @@ class UpstoxWSClient:
                 pass
 
     async def _main_loop(self):
-        backoff = RECONNECT_BASE_DELAY
+        attempt = 0
         while not self._closing:
-            ws_url = get_authorized_ws_url()
+            if not OFF_HOURS_CONNECT and not _market_open_now():
+                logging.info("Market closed; next open in %.0f min. Not connecting.", _seconds_until_open() / 60)
+                # sleep in short slices so stop() is not held up for hours
+                while not self._closing and not _market_open_now():
+                    await asyncio.sleep(min(_seconds_until_open(), 60))
+                continue
+            # blocking HTTP call - run it off the event loop so close/stop stay responsive
+            ws_url, delay_hint = await asyncio.to_thread(_authorize)
             if not ws_url:
-                logging.warning("No ws url; backing off %.1fs", backoff)
-                await asyncio.sleep(backoff + random.random()*0.5)
-                backoff = min(backoff * 2, RECONNECT_MAX_DELAY)
+                attempt += 1
+                sleep_for = _backoff_delay(attempt)
+                if delay_hint is not None:
+                    # honour the server's hint, but never below our own backoff (Retry-After: 0
+                    # would hammer authorize) nor so long that one sleep ignores stop() for ages
+                    sleep_for = min(max(delay_hint, sleep_for), RETRY_AFTER_MAX)
+                logging.warning("No ws url; backing off %.1fs", sleep_for)
+                await asyncio.sleep(sleep_for)
                 continue
 
             try:
@@ -161,7 +334,7 @@ class UpstoxWSClient:
                 logging.info("Connecting to WS: %s ...", ws_url[:80])
                 async with websockets.connect(ws_url, ssl=ssl_ctx, max_size=None, ping_interval=None) as ws:
                     self.ws = ws
-                    backoff = RECONNECT_BASE_DELAY
+                    attempt = 0
                     self._connected_event.set()
                     logging.info("WebSocket connected.")
 
@@ -169,6 +342,13 @@ class UpstoxWSClient:
                     consumer_task = asyncio.create_task(self._consumer_loop(ws))
                     heartbeat_task = asyncio.create_task(self._heartbeat_loop(ws))
 
+                    # a fresh connection has no server-side subscriptions: replay the ones
+                    # we held before the drop (minus pending removals) with the pending keys
+                    with self._lock:
+                        self._pending_subscribe |= self.subscriptions - self._pending_unsubscribe
+                        self._pending_unsubscribe.clear()
+                        self.subscriptions.clear()
+
                     # initial subscribe pending keys
                     await self._flush_pending_subscriptions(ws)
 
@@ -188,16 +368,20 @@ class UpstoxWSClient:
             self.ws = None
             if self._closing:
                 break
-            sleep_for = backoff + random.random() * 0.5
+            attempt += 1
+            sleep_for = _backoff_delay(attempt)
             logging.info("Reconnecting after %.1fs...", sleep_for)
             await asyncio.sleep(sleep_for)
-            backoff = min(backoff * 2, RECONNECT_MAX_DELAY)
 
     async def _heartbeat_loop(self, ws):
         """Optional: send heartbeat or ping if required by server; placeholder."""
         try:
             while True:
                 await asyncio.sleep(HEARTBEAT_INTERVAL)
+                if not OFF_HOURS_CONNECT and not _market_open_now():
+                    logging.info("Market closed; closing feed until next session.")
+                    await ws.close()
+                    return
                 # If server expects a special heartbeat JSON, send here.
                 try:
                     await ws.ping()
@@ -227,6 +411,10 @@ class UpstoxWSClient:
 
     async def _flush_pending_subscriptions(self, ws):
         """Send subscribe/unsubscribe messages for pending sets."""
+        # runs before every recv: skip the lock and list copies when nothing is queued.
+        # an unlocked emptiness check is safe - a key added concurrently is picked up next pass.
+        if not self._pending_subscribe and not self._pending_unsubscribe:
+            return
         # copy and clear pending sets under lock
         with self._lock:
             subs = list(self._pending_subscribe)
@@ -241,12 +429,11 @@ class UpstoxWSClient:
                 "instruments": unsubs
             }
             try:
-                await ws.send(json.dumps(msg))
+                await ws.send(_json_dumps(msg))
                 logging.info("Sent unsubscribe for %d instruments.", len(unsubs))
                 # reflect in subscriptions set
                 with self._lock:
-                    for k in unsubs:
-                        self.subscriptions.discard(k)
+                    self.subscriptions.difference_update(unsubs)
             except Exception as e:
                 logging.warning("Failed to send unsubscribe: %s", e)
 
@@ -259,33 +446,37 @@ class UpstoxWSClient:
                     "instruments": batch
                 }
                 try:
-                    await ws.send(json.dumps(msg))
+                    await ws.send(_json_dumps(msg))
                     logging.info("Sent subscribe for %d instruments.", len(batch))
                     with self._lock:
-                        for k in batch:
-                            self.subscriptions.add(k)
+                        self.subscriptions.update(batch)
                 except Exception as e:
                     logging.warning("Failed to send subscribe: %s", e)
                     # if subscribe fails, put them back to pending set to retry later
                     with self._lock:
-                        for k in batch:
-                            self._pending_subscribe.add(k)
+                        self._pending_subscribe.update(batch)
 
     async def _handle_text_message(self, raw):
         logging.debug("WS text: %s", raw)
         # typical server messages: acks, unsubscribes, errors, heartbeats - parse as JSON if possible
         try:
-            j = json.loads(raw)
-            # handle possible subscription ack or error
-            if j.get("type") == "subscription_ack":
-                logging.info("Subscription ack: %s", j)
-            elif j.get("type") == "error":
-                logging.warning("Server error: %s", j)
-            else:
-                # generic text message - forward to callback
-                self.on_tick(j)
-        except Exception:
+            j = _json_loads(raw)
+        except ValueError:
             logging.debug("WS text not JSON: %s", raw)
+            return
+        if not isinstance(j, dict):
+            # on_tick is documented to receive dicts - don't hand it bare JSON values
+            logging.debug("WS text JSON is not an object, ignored: %s", raw)
+            return
+        # handle possible subscription ack or error
+        mtype = j.get("type")
+        if mtype == "subscription_ack":
+            logging.info("Subscription ack: %s", j)
+        elif mtype == "error":
+            logging.warning("Server error: %s", j)
+        else:
+            # generic text message - forward to callback
+            self._emit(j)
 
     async def _handle_binary_message(self, raw):
         logging.debug("WS binary message len=%d", len(raw))
@@ -296,15 +487,15 @@ class UpstoxWSClient:
                 fb.ParseFromString(raw)
                 # Convert proto to dict for ease of use (you can tailor which fields to send)
                 msg = _proto_to_dict(fb)
-                self.on_tick(msg)
+                self._emit(msg)
             except Exception as e:
                 logging.exception("Proto parse failed: %s", e)
                 # fallback: pass binary length
-                self.on_tick({"binary_len": len(raw)})
+                self._emit({"binary_len": len(raw)})
         else:
             # No proto available: just expose raw bytes length and hex snippet
             snippet = raw[:64].hex()
-            self.on_tick({"binary_len": len(raw), "snippet": snippet})
+            self._emit({"binary_len": len(raw), "snippet": snippet})
 
 def _proto_to_dict(fb):
     """